@@ -1,5 +1,6 @@
 __doc__ = 'High level abstract datatypes'
 
+import math
 from collections import defaultdict
 
 
@@ -67,3 +68,60 @@ class HashDict:
         """get the hash value of this value
         """
         return hash(value)
+
+
+class SpatialIndex:
+    """Index (latitude, longitude) points to check whether any is within a distance of a new point
+    Points are stored as unit vectors in a 3D grid with cells the size of the chord for this distance,
+    so only the neighbouring cells need to be checked rather than every point
+
+    arc:
+        the distance as an angle in radians, ie a ratio of the earth's radius
+
+    >>> index = SpatialIndex(0.001)
+    >>> index.add((-37.7833, 144.9667))
+    >>> index.near((-37.7834, 144.9668))
+    True
+    >>> index.near((37.7750, -122.4183))
+    False
+    >>> len(index)
+    1
+    """
+    def __init__(self, arc):
+        # points closer than this arc are closer than this straight line chord
+        self.chord = 2 * math.sin(min(arc, math.pi) / 2)
+        self.cell_size = self.chord or 1.0
+        self.cells = defaultdict(list)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _vector(self, point):
+        lat, lng = math.radians(point[0]), math.radians(point[1])
+        cos_lat = math.cos(lat)
+        return cos_lat * math.cos(lng), cos_lat * math.sin(lng), math.sin(lat)
+
+    def _cell(self, v):
+        return tuple(int(math.floor(c / self.cell_size)) for c in v)
+
+    def add(self, point):
+        """Add this (latitude, longitude) point to the index
+        """
+        v = self._vector(point)
+        self.cells[self._cell(v)].append(v)
+        self.count += 1
+
+    def near(self, point):
+        """Return whether an indexed point is within the arc of this (latitude, longitude) point
+        """
+        x, y, z = v = self._vector(point)
+        cx, cy, cz = self._cell(v)
+        max_squared = self.chord * self.chord
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    for ox, oy, oz in self.cells.get((cx + dx, cy + dy, cz + dz), ()):
+                        if (x - ox) ** 2 + (y - oy) ** 2 + (z - oz) ** 2 < max_squared:
+                            return True
+        return False
@@ -1,7 +1,42 @@
 __doc__ = 'High level functions for interpreting useful data from input'
 
-import csv, logging, math, os, random, re, urllib
-from . import common, xpath
+import csv, itertools, math, re, urllib
+from . import adt, common, xpath
+
+
+_EMAIL_RE = re.compile(r'([\w.\-+]{1,64})@(\w[\w.-]{1,255})\.(\w+)')
+_OBF_EMAIL_RE = re.compile(r'(?i)([\w.\-+]{1,64})\s?.?AT.?\s?([\w.-]{1,255})\s?.?DOT.?\s?(\w+)')
+_DIGIT_RE = re.compile(r'\d')
+_PHONE_RE = re.compile(r'(\+\d{1,2}\s)?\(?\d{3}\)?[\s.-]\d{3}[\s.-]\d{4}')
+_TEL_RE = re.compile(r'tel:(\d+)')
+_ADDR_RE = re.compile(r'([A-Z]{2,})\s*(\d[\d\-\s]+\d)')
+_JS_HREF_RE = re.compile(r'location\.href ?= ?[\'"](.*?)[\'"]')
+# schemes other than http(s), matching how urlsplit identifies a scheme
+_OTHER_SCHEME_RE = re.compile(r'\s*(?!https?:)[a-zA-Z][a-zA-Z0-9+.\-]*:', re.IGNORECASE)
+
+
+def _strip_comments(html):
+    """Remove HTML comments, scanning with str.find rather than a regex
+
+    >>> _strip_comments('a<!-- b -->c<!-- d')
+    'ac<!-- d'
+    """
+    if '<!--' not in html:
+        return html
+    fragments = []
+    i = 0
+    while True:
+        start = html.find('<!--', i)
+        if start == -1:
+            break
+        end = html.find('-->', start + 4)
+        if end == -1:
+            # unterminated comment is kept
+            break
+        fragments.append(html[i:start])
+        i = end + 3
+    fragments.append(html[i:])
+    return ''.join(fragments)
 
 
 def get_links(html, url=None, local=True, external=True):
@@ -17,32 +52,33 @@ def get_links(html, url=None, local=True, external=True):
         whether to include linkes from other domains
     """
     def normalize_link(link):
-        if urllib.parse.urlsplit(link).scheme in ('http', 'https', ''):
+        # cheap prefix test for the scheme rather than splitting the whole URL
+        if not _OTHER_SCHEME_RE.match(link):
             if '#' in link:
                 link = link[:link.index('#')]
             if url:
                 link = urllib.parse.urljoin(url, link)
-                if not local and common.same_domain(url, link):
-                    # local links not included
-                    link = None
-                if not external and not common.same_domain(url, link):
-                    # external links not included
-                    link = None
+                if not (local and external):
+                    is_local = common.same_domain(url, link)
+                    if (is_local and not local) or (not is_local and not external):
+                        # local or external links not included
+                        link = None
         else:
             link = None # ignore mailto, etc
         return link
     tree = xpath.Tree(html)
-    a_links = tree.search('//a/@href')
-    i_links = tree.search('//iframe/@src')
-    js_links = re.findall('location.href ?= ?[\'"](.*?)[\'"]', html)
-    links = []
-    for link in a_links + i_links + js_links:
+    # query the attribute strings directly in a single pass rather than wrapping each in a Tree, which would parse it as HTML
+    attr_links = tree.doc.xpath('//a/@href | //iframe/@src') if tree else []
+    js_links = _JS_HREF_RE.findall(html)
+    links, seen = [], set()
+    for link in itertools.chain(attr_links, js_links):
         try:
             link = normalize_link(str(link))
         except UnicodeError:
             pass
         else:
-            if link and link not in links:
+            if link and link not in seen:
+                seen.add(link)
                 links.append(link)
     return links
 
@@ -66,22 +102,24 @@ def extract_emails(html, ignored=None):
     >>> extract_emails('<a href="mailto:first.last@mail.co.uk">Contact</a>')
     ['first.last@mail.co.uk']
     """
-    emails = []
+    emails, seen = [], set()
     if html:
-        email_re = re.compile('([\w\.\-\+]{1,64})@(\w[\w\.-]{1,255})\.(\w+)')
         # remove comments, which can obfuscate emails
-        html = re.compile('<!--.*?-->', re.DOTALL).sub('', html).replace('mailto:', '')
-        for user, domain, ext in email_re.findall(html):
-            if ext.lower() not in common.MEDIA_EXTENSIONS and len(ext)>=2 and not re.compile('\d').search(ext) and domain.count('.')<=3:
+        html = _strip_comments(html).replace('mailto:', '')
+        for user, domain, ext in _EMAIL_RE.findall(html):
+            # filtered after matching rather than in the pattern, where a rejected candidate would backtrack into a different match
+            if ext.lower() not in common.MEDIA_EXTENSIONS and len(ext)>=2 and not _DIGIT_RE.search(ext) and domain.count('.')<=3:
                 email = '%s@%s.%s' % (user, domain, ext)
-                if email not in emails:
+                if email not in seen:
+                    seen.add(email)
                     emails.append(email)
 
         # look for obfuscated email
-        for user, domain, ext in re.compile('([\w\.\-\+]{1,64})\s?.?AT.?\s?([\w\.-]{1,255})\s?.?DOT.?\s?(\w+)', re.IGNORECASE).findall(html):
-            if ext.lower() not in common.MEDIA_EXTENSIONS and len(ext)>=2 and not re.compile('\d').search(ext) and domain.count('.')<=3:
+        for user, domain, ext in _OBF_EMAIL_RE.findall(html):
+            if ext.lower() not in common.MEDIA_EXTENSIONS and len(ext)>=2 and not _DIGIT_RE.search(ext) and domain.count('.')<=3:
                 email = '%s@%s.%s' % (user, domain, ext)
-                if email not in emails:
+                if email not in seen:
+                    seen.add(email)
                     emails.append(email)
     if ignored:
         emails = [email for email in emails if email not in ignored]
@@ -102,7 +140,7 @@ def extract_phones(html):
     >>> extract_phones('<a href="tel:0234673460">Contact</a>')
     ['0234673460']
     """
-    return [match.group() for match in re.finditer('(\+\d{1,2}\s)?\(?\d{3}\)?[\s.-]\d{3}[\s.-]\d{4}', html)] + re.findall('tel:(\d+)', html)
+    return [match.group() for match in _PHONE_RE.finditer(html)] + _TEL_RE.findall(html)
 
 
 def parse_us_address(address):
@@ -110,17 +148,19 @@ def parse_us_address(address):
 
     >>> parse_us_address('6200 20th Street, Vero Beach, FL 32966')
     ('6200 20th Street', 'Vero Beach', 'FL', '32966')
+    >>> parse_us_address('Vero Beach, FL 32966')
+    ('Vero Beach', '', 'FL', '32966')
     """
     city = state = zipcode = ''
-    addrs = map(lambda x:x.strip(), address.split(','))
+    addrs = [a.strip() for a in address.split(',')]
     if addrs:
-        m = re.compile('([A-Z]{2,})\s*(\d[\d\-\s]+\d)').search(addrs[-1])
+        m = _ADDR_RE.search(addrs[-1])
         if m:
             state = m.groups()[0].strip()
             zipcode = m.groups()[1].strip()
 
             if len(addrs)>=3:
-                city = addrs[-2].strip()
+                city = addrs[-2]
                 address = ','.join(addrs[:-2])
             else:
                 address = ','.join(addrs[:-1])
@@ -128,14 +168,16 @@ def parse_us_address(address):
     return address, city, state, zipcode
 
 
+_DEG_PER_RAD = 180 / math.pi
+_RAD_PER_DEG = math.pi / 180.0
+
+# radius of the earth for each supported distance scale
+EARTH_RADIUS = {None: 1.0, 'km': 6373.0, 'miles': 3960.0}
+
 def get_earth_radius(scale):
-    if scale is None:
-        return 1.0
-    elif scale == 'km':
-        return 6373.0
-    elif scale == 'miles':
-        return 3960.0
-    else:
+    try:
+        return EARTH_RADIUS[scale]
+    except (KeyError, TypeError):
         raise common.WebScrapingError('Invalid scale: %s' % str(scale))
 
 
@@ -151,45 +193,46 @@ def distance(p1, p2, scale=None):
     >>> int(distance(melbourne, san_francisco, 'km'))
     12659
     """
-    if p1 == p2:
+    if abs(p1[0] - p2[0]) < 1e-9 and abs(p1[1] - p2[1]) < 1e-9:
+        # same or numerically coincident points
         return 0
-    lat1, long1 = p1
-    lat2, long2 = p2
-    # Convert latitude and longitude to 
-    # spherical coordinates in radians.
-    degrees_to_radians = math.pi / 180.0
-        
-    # phi = 90 - latitude
-    phi1 = (90.0 - lat1)*degrees_to_radians
-    phi2 = (90.0 - lat2)*degrees_to_radians
-        
-    # theta = longitude
-    theta1 = long1*degrees_to_radians
-    theta2 = long2*degrees_to_radians
-        
-    cos = (math.sin(phi1)*math.sin(phi2)*math.cos(theta1 - theta2) + math.cos(phi1)*math.cos(phi2))
-    arc = math.acos(cos)
+    arc = _haversine(math.radians(p1[0]), math.radians(p1[1]), math.radians(p2[0]), math.radians(p2[1]))
     return arc * get_earth_radius(scale)
 
 
+def _haversine(lat1, lng1, lat2, lng2):
+    """Return the angle in radians between 2 points given in radians
+
+    Uses the haversine formula, which unlike the spherical law of cosines stays accurate for nearby points
+    """
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    # rounding can push antipodal points just past 1
+    a = min(a, 1.0)
+    return 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
 def find_coordinates(ch_lat=100, ch_lng=100, ch_scale='miles', min_lat=-90, max_lat=90, min_lng=-180, max_lng=180):
     """Find all latitude/longitude coordinates within bounding box, with given increments
     """
+    r_earth = get_earth_radius(ch_scale)
+    lat_step = (ch_lat / r_earth) * _DEG_PER_RAD
     cur_lat = min_lat
     while cur_lat < max_lat:
+        # longitude step only depends on the latitude, so calculate once per band
+        lng_step = (ch_lng / r_earth) * _DEG_PER_RAD / math.cos(cur_lat * _RAD_PER_DEG)
         cur_lng = min_lng
         while cur_lng < max_lng:
             yield cur_lat, cur_lng
-            _, cur_lng = move_coordinate(cur_lat, cur_lng, 0, ch_lng, ch_scale)
-        cur_lat, _ = move_coordinate(cur_lat, cur_lng, ch_lat, 0, ch_scale)
+            cur_lng += lng_step
+        cur_lat += lat_step
 
 
 def move_coordinate(lat, lng, ch_lat, ch_lng, ch_scale=None):
     """Move latitude/longitude coordinate a given increment
     """
     r_earth = get_earth_radius(ch_scale)
-    new_lat = lat + (ch_lat / r_earth) * (180 / math.pi);
-    new_lng = lng + (ch_lng / r_earth) * (180 / math.pi) / math.cos(lat * math.pi/180.0)
+    new_lat = lat + (ch_lat / r_earth) * _DEG_PER_RAD
+    new_lng = lng + (ch_lng / r_earth) * _DEG_PER_RAD / math.cos(lat * _RAD_PER_DEG)
     return new_lat, new_lng
 
 
@@ -200,29 +243,40 @@ def get_zip_codes(filename, min_distance=100, scale='miles', lat_key='Latitude',
         yield zip_code
 
 def get_zip_lat_lngs(filename, min_distance=100, scale='miles', lat_key='Latitude', lng_key='Longitude', zip_key='Zip'):
-    locations = []
-    for record in csv.DictReader(open(filename)):
-        lat, lng = float(record[lat_key]), float(record[lng_key])
-        for other_lat, other_lng in locations:
-            if distance((lat, lng), (other_lat, other_lng), scale=scale) < min_distance:
-                break
-        else:
-            locations.append((lat, lng))
-            yield record[zip_key], record[lat_key], record[lng_key]
+    # spatial index so each record is only compared to accepted locations nearby
+    locations = adt.SpatialIndex(min_distance / get_earth_radius(scale))
+    with open(filename, newline='', buffering=1 << 20) as fp:
+        reader = csv.reader(fp)
+        header = next((row for row in reader if row), None)
+        if header is None:
+            return
+        zip_index, lat_index, lng_index = header.index(zip_key), header.index(lat_key), header.index(lng_key)
+        for row in reader:
+            if not row:
+                continue # blank line
+            location = float(row[lat_index]), float(row[lng_index])
+            if not locations.near(location):
+                locations.add(location)
+                yield row[zip_index], row[lat_index], row[lng_index]
 
 
 def find_json_path(e, value, path=''):
     """Find the JSON path that points to this value
+
+    >>> find_json_path({'a': [1, {'b': 2}], 'c': 2}, 2)
+    ['["a"][1]["b"]', '["c"]']
     """
     results = []
-    if e == value:
-        results.append(path)
-    if isinstance(e, dict):
-        for k, v in e.items():
-            key_path = '{}["{}"]'.format(path, k)
-            results.extend(find_json_path(v, value, key_path))
-    elif isinstance(e, list):
-        for i, v in enumerate(e):
-            index_path = '{}[{}]'.format(path, i)
-            results.extend(find_json_path(v, value, index_path))
+    is_container = isinstance(value, (dict, list))
+    stack = [(e, path)]
+    while stack:
+        e, path = stack.pop()
+        # only compare containers of the same type, which avoids traversing subtrees that can not match
+        if (type(e) is type(value) if is_container else not isinstance(e, (dict, list))) and e == value:
+            results.append(path)
+        # children are pushed in reverse so are visited in document order
+        if isinstance(e, dict):
+            stack.extend((v, f'{path}["{k}"]') for k, v in reversed(list(e.items())))
+        elif isinstance(e, list):
+            stack.extend((e[i], f'{path}[{i}]') for i in reversed(range(len(e))))
     return results
@@ -9,9 +9,9 @@ csv.field_size_limit(sys.maxsize)
 import time
 import glob
 import json
-import string
 import urllib.parse
 import itertools
+import functools
 import html.entities
 import logging
 import logging.handlers
@@ -30,16 +30,39 @@ class WebScrapingError(Exception):
 
 
 # known media file extensions
-MEDIA_EXTENSIONS = ['ai', 'aif', 'aifc', 'aiff', 'asc', 'avi', 'bcpio', 'bin', 'c', 'cc', 'ccad', 'cdf', 'class', 'cpio', 'cpt', 'csh', 'css', 'csv', 'dcr', 'dir', 'dms', 'doc', 'drw', 'dvi', 'dwg', 'dxf', 'dxr', 'eps', 'etx', 'exe', 'ez', 'f', 'f90', 'fli', 'flv', 'gif', 'gtar', 'gz', 'h', 'hdf', 'hh', 'hqx', 'ice', 'ico', 'ief', 'iges', 'igs', 'imq', 'ips', 'ipx', 'jpe', 'jpeg', 'jpg', 'js', 'kar', 'latex', 'lha', 'lsp', 'lzh', 'm', 'man', 'me', 'mesh', 'mid', 'midi', 'mif', 'mime', 'mov', 'movie', 'mp2', 'mp3', 'mpe', 'mpeg', 'mpg', 'mpga', 'ms', 'msh', 'nc', 'oda', 'pbm', 'pdb', 'pdf', 'pgm', 'pgn', 'png', 'pnm', 'pot', 'ppm', 'pps', 'ppt', 'ppz', 'pre', 'prt', 'ps', 'qt', 'ra', 'ram', 'ras', 'raw', 'rgb', 'rm', 'roff', 'rpm', 'rtf', 'rtx', 'scm', 'set', 'sgm', 'sgml', 'sh', 'shar', 'silo', 'sit', 'skd', 'skm', 'skp', 'skt', 'smi', 'smil', 'snd', 'sol', 'spl', 'src', 'step', 'stl', 'stp', 'sv4cpio', 'sv4crc', 'swf', 't', 'tar', 'tcl', 'tex', 'texi', 'tif', 'tiff', 'tr', 'tsi', 'tsp', 'tsv', 'unv', 'ustar', 'vcd', 'vda', 'viv', 'vivo', 'vrml', 'w2p', 'wav', 'wmv', 'wrl', 'xbm', 'xlc', 'xll', 'xlm', 'xls', 'xlw', 'xml', 'xpm', 'xsl', 'xwd', 'xyz', 'zip']
+MEDIA_EXTENSIONS = frozenset(['ai', 'aif', 'aifc', 'aiff', 'asc', 'avi', 'bcpio', 'bin', 'c', 'cc', 'ccad', 'cdf', 'class', 'cpio', 'cpt', 'csh', 'css', 'csv', 'dcr', 'dir', 'dms', 'doc', 'drw', 'dvi', 'dwg', 'dxf', 'dxr', 'eps', 'etx', 'exe', 'ez', 'f', 'f90', 'fli', 'flv', 'gif', 'gtar', 'gz', 'h', 'hdf', 'hh', 'hqx', 'ice', 'ico', 'ief', 'iges', 'igs', 'imq', 'ips', 'ipx', 'jpe', 'jpeg', 'jpg', 'js', 'kar', 'latex', 'lha', 'lsp', 'lzh', 'm', 'man', 'me', 'mesh', 'mid', 'midi', 'mif', 'mime', 'mov', 'movie', 'mp2', 'mp3', 'mpe', 'mpeg', 'mpg', 'mpga', 'ms', 'msh', 'nc', 'oda', 'pbm', 'pdb', 'pdf', 'pgm', 'pgn', 'png', 'pnm', 'pot', 'ppm', 'pps', 'ppt', 'ppz', 'pre', 'prt', 'ps', 'qt', 'ra', 'ram', 'ras', 'raw', 'rgb', 'rm', 'roff', 'rpm', 'rtf', 'rtx', 'scm', 'set', 'sgm', 'sgml', 'sh', 'shar', 'silo', 'sit', 'skd', 'skm', 'skp', 'skt', 'smi', 'smil', 'snd', 'sol', 'spl', 'src', 'step', 'stl', 'stp', 'sv4cpio', 'sv4crc', 'swf', 't', 'tar', 'tcl', 'tex', 'texi', 'tif', 'tiff', 'tr', 'tsi', 'tsp', 'tsv', 'unv', 'ustar', 'vcd', 'vda', 'viv', 'vivo', 'vrml', 'w2p', 'wav', 'wmv', 'wrl', 'xbm', 'xlc', 'xll', 'xlm', 'xls', 'xlw', 'xml', 'xpm', 'xsl', 'xwd', 'xyz', 'zip'])
 
 # tags that do not contain content
-EMPTY_TAGS = 'br', 'hr', 'meta', 'link', 'base', 'img', 'embed', 'param', 'area', 'col', 'input'
+EMPTY_TAGS = frozenset(['br', 'hr', 'meta', 'link', 'base', 'img', 'embed', 'param', 'area', 'col', 'input'])
+
+# top level and second level domain suffixes used by get_domain
+_TLD_SUFFIXES = frozenset(['ac', 'ad', 'ae', 'aero', 'af', 'ag', 'ai', 'al', 'am', 'an', 'ao', 'aq', 'ar', 'arpa', 'as', 'asia', 'at', 'au', 'aw', 'ax', 'az', 'ba', 'bb', 'bd', 'be', 'bf', 'bg', 'bh', 'bi', 'biz', 'bj', 'bm', 'bn', 'bo', 'br', 'bs', 'bt', 'bv', 'bw', 'by', 'bz', 'ca', 'cat', 'cc', 'cd', 'cf', 'cg', 'ch', 'ci', 'ck', 'cl', 'cm', 'cn', 'co', 'com', 'coop', 'cr', 'cu', 'cv', 'cx', 'cy', 'cz', 'de', 'dj', 'dk', 'dm', 'do', 'dz', 'ec', 'edu', 'ee', 'eg', 'er', 'es', 'et', 'eu', 'fi', 'fj', 'fk', 'fm', 'fo', 'fr', 'ga', 'gb', 'gd', 'ge', 'gf', 'gg', 'gh', 'gi', 'gl', 'gm', 'gn', 'gov', 'gp', 'gq', 'gr', 'gs', 'gt', 'gu', 'gw', 'gy', 'hk', 'hm', 'hn', 'hr', 'ht', 'hu', 'id', 'ie', 'il', 'im', 'in', 'info', 'int', 'io', 'iq', 'ir', 'is', 'it', 'je', 'jm', 'jo', 'jobs', 'jp', 'ke', 'kg', 'kh', 'ki', 'km', 'kn', 'kp', 'kr', 'kw', 'ky', 'kz', 'la', 'lb', 'lc', 'li', 'lk', 'lr', 'ls', 'lt', 'lu', 'lv', 'ly', 'ma', 'mc', 'md', 'me', 'mg', 'mh', 'mil', 'mk', 'ml', 'mm', 'mn', 'mo', 'mobi', 'mp', 'mq', 'mr', 'ms', 'mt', 'mu', 'mv', 'mw', 'mx', 'my', 'mz', 'na', 'name', 'nc', 'ne', 'net', 'nf', 'ng', 'ni', 'nl', 'no', 'np', 'nr', 'nu', 'nz', 'om', 'org', 'pa', 'pe', 'pf', 'pg', 'ph', 'pk', 'pl', 'pm', 'pn', 'pr', 'pro', 'ps', 'pt', 'pw', 'py', 'qa', 're', 'ro', 'rs', 'ru', 'rw', 'sa', 'sb', 'sc', 'sd', 'se', 'sg', 'sh', 'si', 'sj', 'sk', 'sl', 'sm', 'sn', 'so', 'sr', 'st', 'su', 'sv', 'sy', 'sz', 'tc', 'td', 'tel', 'tf', 'tg', 'th', 'tj', 'tk', 'tl', 'tm', 'tn', 'to', 'tp', 'tr', 'tt', 'tv', 'tw', 'tz', 'ua', 'ug', 'uk', 'us', 'uy', 'uz', 'va', 'vc', 've', 'vg', 'vi', 'vn', 'vu', 'wf', 'ws', 'xn', 'ye', 'yt', 'za', 'zm', 'zw'])
+
+# patterns used by the functions below, compiled once at import
+_EMPTY_TAGS_RE = re.compile('<(%s)[^>]*>' % '|'.join(sorted(EMPTY_TAGS)))
+_TAG_NAME_RE = re.compile(r'<(\w+?)\W')
+_STRIP_TAG_RE = re.compile(r'<[^<]*?>')
+_COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+_WS_RE = re.compile(r'\s+')
+_NL_RE = re.compile(r'[\n\r]+')
+_SPACE_RE = re.compile(r'[ \t\f\v]+')
+_IS_HTML_RE = re.compile('html|head|body')
+_IS_URL_RE = re.compile('https?://')
+_DOMAIN_IP_RE = re.compile(r'^.*://(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})')
+_STRIP_SCHEME_RE = re.compile('^.*://')
+# comments, tags, and entities using the same entity syntax as html.unescape
+_NORMALIZE_RE = re.compile(r'<!--.*?-->|<[^<]*?>|&(?:#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[^\t\n\f <&#;]{1,32};?)', re.DOTALL)
+_NON_NUMERIC_RE = re.compile(r'[^0-9.\-]+')
+_PROXY_RE = re.compile(r'((?P<username>\w+):(?P<password>\w+)@)?(?P<host>\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3})(:(?P<port>\d+))?')
 
 
 def to_ascii(html):
     """Return ascii part of html
+
+    >>> to_ascii('caf\xe9 au lait')
+    'caf au lait'
     """
-    return ''.join(c for c in (html or '') if ord(c) < 128)
+    return (html or '').encode('ascii', 'ignore').decode('ascii')
 
 def to_int(s, default=0):
     """Return integer from this string
@@ -77,9 +100,8 @@ def to_float(s, default=0.0):
     """
     result = default
     if s:
-        valid = string.digits + '.-'
         try:
-            result = float(''.join(c for c in str(s) if c in valid))
+            result = float(_NON_NUMERIC_RE.sub('', str(s)))
         except ValueError:
             pass # input does not contain a number
     return result
@@ -89,7 +111,7 @@ def is_html(html):
     """Returns whether content is likely HTML based on search for common tags
     """
     try:
-        result = re.search('html|head|body', html) is not None
+        result = _IS_HTML_RE.search(html) is not None
     except TypeError:
         result = False
     return result
@@ -105,7 +127,7 @@ def is_url(text):
     >>> is_url('http://webscraping.com/blog')
     True
     """
-    return re.match('https?://', text) is not None
+    return _IS_URL_RE.match(text) is not None
 
 
 def unique(l):
@@ -117,12 +139,18 @@ def unique(l):
     []
     >>> unique([3,6,4])
     [3, 6, 4]
+    >>> unique([[1], [2], [1]])
+    [[1], [2]]
     """
-    checked = []
-    for e in l:
-        if e not in checked:
-            checked.append(e)
-    return checked
+    try:
+        return list(dict.fromkeys(l))
+    except TypeError:
+        # unhashable elements
+        checked = []
+        for e in l:
+            if e not in checked:
+                checked.append(e)
+        return checked
 
 
 def flatten(l):
@@ -131,7 +159,7 @@ def flatten(l):
     >>> flatten([[1,2,3], [4,5,6]])
     [1, 2, 3, 4, 5, 6]
     """
-    return [item for sublist in l for item in sublist]
+    return list(itertools.chain.from_iterable(l))
 
 
 def nth(l, i, default=''):
@@ -173,19 +201,29 @@ def pad(l, size, default=None, end=True):
     >>> pad(range(5), 7, end=False)
     [None, None, 0, 1, 2, 3, 4]
     """
-    while len(l) < size:
+    if not isinstance(l, list):
+        l = list(l)
+    diff = size - len(l)
+    if diff > 0:
         if end:
-            l.append(default)
+            l.extend([default] * diff)
         else:
-            l.insert(0, default)
-    while len(l) > size:
+            l[:0] = [default] * diff
+    elif diff < 0:
         if end:
-            l.pop()
+            del l[diff:]
         else:
-            l.pop(0)
+            del l[:-diff]
     return l
 
 
+@functools.lru_cache(maxsize=256)
+def _tags_re(tags):
+    """Return compiled regex matching any of this frozenset of tags and their content
+    """
+    return re.compile(r'<\s*(%s)\b.*?>.*?</\s*\1\s*>' % '|'.join(map(re.escape, sorted(tags))), re.DOTALL)
+
+
 def remove_tags(html, keep_children=True):
     """Remove HTML tags leaving just text
     If keep children is True then keep text within child tags
@@ -201,14 +239,21 @@ def remove_tags(html, keep_children=True):
     """
     if isinstance(html, xpath.Tree):
         html = str(html)
-    html = re.sub('<(%s)[^>]*>' % '|'.join(EMPTY_TAGS), '', html)
+    html = _EMPTY_TAGS_RE.sub('', html)
     if not keep_children:
-        for tag in unique(re.findall('<(\w+?)\W', html)):
-            if tag not in EMPTY_TAGS:
-                html = re.compile('<\s*%s.*?>.*?</\s*%s\s*>' % (tag, tag), re.DOTALL).sub('', html)
-    return re.compile('<[^<]*?>').sub('', html)
+        tags = frozenset(_TAG_NAME_RE.findall(html)).difference(EMPTY_TAGS)
+        if tags:
+            html = _tags_re(tags).sub('', html)
+    return _STRIP_TAG_RE.sub('', html)
     
 
+def _normalize_token(m):
+    """Unescape an entity matched by _NORMALIZE_RE, else remove the matched comment or tag
+    """
+    token = m.group()
+    return unescape(token) if token[0] == '&' else ''
+
+
 def normalize(s, encoding=settings.default_encoding, newlines=False):
     """Normalize the string by removing tags, unescaping, and removing surrounding whitespace
     
@@ -218,16 +263,19 @@ def normalize(s, encoding=settings.default_encoding, newlines=False):
     if isinstance(s, xpath.Tree):
         s = str(s)
     if isinstance(s, str):
-        # remove tags and set encoding
-        s = unescape(remove_tags(s))#, encoding=encoding, keep_unicode=isinstance(s, unicode))
+        # remove comments and tags and unescape entities in a single pass
+        s = _NORMALIZE_RE.sub(_normalize_token, s)
         if newlines:
             # keep multiple newlines
-            s = re.sub('[\n\r]+', '\n', s)
-            s = re.sub('[ \t\f\v]+', ' ', s)
+            s = _NL_RE.sub('\n', s)
+            s = _SPACE_RE.sub(' ', s)
         else:
             # replace all subsequent whitespace with single space
-            s = re.sub('[\s]+', ' ', s) 
-        s = re.compile('<!--.*?-->', re.DOTALL).sub('', s).strip()
+            s = _WS_RE.sub(' ', s)
+        if '<!--' in s:
+            # comments that were escaped
+            s = _COMMENT_RE.sub('', s)
+        s = s.strip()
     return s
 
 
@@ -271,6 +319,7 @@ def get_extension(url):
     return os.path.splitext(urlparse.urlsplit(url).path)[-1].lower().replace('.', '')
 
 
+@functools.lru_cache(maxsize=4096)
 def get_domain(url):
     """Extract the domain from the given URL
 
@@ -279,16 +328,15 @@ def get_domain(url):
     >>> get_domain('www.google.com')
     'google.com'
     """
-    m = re.compile(r"^.*://(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})").search(url)
+    m = _DOMAIN_IP_RE.search(url)
     if m:
         # an IP address
         return m.groups()[0]
     
-    suffixes = 'ac', 'ad', 'ae', 'aero', 'af', 'ag', 'ai', 'al', 'am', 'an', 'ao', 'aq', 'ar', 'arpa', 'as', 'asia', 'at', 'au', 'aw', 'ax', 'az', 'ba', 'bb', 'bd', 'be', 'bf', 'bg', 'bh', 'bi', 'biz', 'bj', 'bm', 'bn', 'bo', 'br', 'bs', 'bt', 'bv', 'bw', 'by', 'bz', 'ca', 'cat', 'cc', 'cd', 'cf', 'cg', 'ch', 'ci', 'ck', 'cl', 'cm', 'cn', 'co', 'com', 'coop', 'cr', 'cu', 'cv', 'cx', 'cy', 'cz', 'de', 'dj', 'dk', 'dm', 'do', 'dz', 'ec', 'edu', 'ee', 'eg', 'er', 'es', 'et', 'eu', 'fi', 'fj', 'fk', 'fm', 'fo', 'fr', 'ga', 'gb', 'gd', 'ge', 'gf', 'gg', 'gh', 'gi', 'gl', 'gm', 'gn', 'gov', 'gp', 'gq', 'gr', 'gs', 'gt', 'gu', 'gw', 'gy', 'hk', 'hm', 'hn', 'hr', 'ht', 'hu', 'id', 'ie', 'il', 'im', 'in', 'info', 'int', 'io', 'iq', 'ir', 'is', 'it', 'je', 'jm', 'jo', 'jobs', 'jp', 'ke', 'kg', 'kh', 'ki', 'km', 'kn', 'kp', 'kr', 'kw', 'ky', 'kz', 'la', 'lb', 'lc', 'li', 'lk', 'lr', 'ls', 'lt', 'lu', 'lv', 'ly', 'ma', 'mc', 'md', 'me', 'mg', 'mh', 'mil', 'mk', 'ml', 'mm', 'mn', 'mo', 'mobi', 'mp', 'mq', 'mr', 'ms', 'mt', 'mu', 'mv', 'mw', 'mx', 'my', 'mz', 'na', 'name', 'nc', 'ne', 'net', 'nf', 'ng', 'ni', 'nl', 'no', 'np', 'nr', 'nu', 'nz', 'om', 'org', 'pa', 'pe', 'pf', 'pg', 'ph', 'pk', 'pl', 'pm', 'pn', 'pr', 'pro', 'ps', 'pt', 'pw', 'py', 'qa', 're', 'ro', 'rs', 'ru', 'rw', 'sa', 'sb', 'sc', 'sd', 'se', 'sg', 'sh', 'si', 'sj', 'sk', 'sl', 'sm', 'sn', 'so', 'sr', 'st', 'su', 'sv', 'sy', 'sz', 'tc', 'td', 'tel', 'tf', 'tg', 'th', 'tj', 'tk', 'tl', 'tm', 'tn', 'to', 'tp', 'tr', 'tt', 'tv', 'tw', 'tz', 'ua', 'ug', 'uk', 'us', 'uy', 'uz', 'va', 'vc', 've', 'vg', 'vi', 'vn', 'vu', 'wf', 'ws', 'xn', 'ye', 'yt', 'za', 'zm', 'zw'
-    url = re.sub('^.*://', '', url).partition('/')[0].lower()
+    url = _STRIP_SCHEME_RE.sub('', url).partition('/')[0].lower()
     domain = []
     for section in url.split('.'):
-        if section in suffixes:
+        if section in _TLD_SUFFIXES:
             domain.append(section)
         else:
             domain = [section]
@@ -329,7 +377,7 @@ def parse_proxy(proxy):
     """
     fragments = adt.Bag()
     if isinstance(proxy, str):
-        match = re.match('((?P<username>\w+):(?P<password>\w+)@)?(?P<host>\d{1,3}.\d{1,3}.\d{1,3}.\d{1,3})(:(?P<port>\d+))?', proxy)
+        match = _PROXY_RE.match(proxy)
         if match:
             groups = match.groupdict()
             fragments.username = groups.get('username') or ''
@@ -344,7 +392,8 @@ def read_list(file):
     """
     l = []
     if os.path.exists(file):
-        l.extend(open(file).read().splitlines())
+        with open(file) as fp:
+            l.extend(line.rstrip('\r\n') for line in fp)
     else:
         logger.debug('%s not found' % file)
     return l
@@ -408,7 +457,12 @@ class UnicodeWriter:
         #row = [self._cell(col) for col in row]
         row = tuple(row)
         if self.unique:
-            key = hash(row)
+            # store the row itself so distinct rows with colliding hashes are both written
+            try:
+                key = row
+                hash(key)
+            except TypeError:
+                key = repr(row) # unhashable cells
             if key not in self.seen:
                 self.seen.add(key)
                 self.writer.writerow(row)
@@ -421,11 +475,14 @@ class UnicodeWriter:
         for row in rows:
             self.writerow(row)
 
-    def flush(self):
-        """Flush output to disk
+    def flush(self, durable=False):
+        """Flush output to the operating system
+
+        durable:
+            whether to also fsync so the output is on disk before returning
         """
         self.fp.flush()
-        if hasattr(self.fp, 'fileno'):
+        if durable and hasattr(self.fp, 'fileno'):
             # this is a real file
             os.fsync(self.fp.fileno())
         
@@ -437,13 +494,13 @@ class UnicodeWriter:
 
 def csv_to_xls(filename):
     from xlsxwriter.workbook import Workbook
-    workbook = Workbook(filename[:-4] + '.xlsx')
+    # constant memory mode flushes each row to disk as it is written
+    workbook = Workbook(filename[:-4] + '.xlsx', {'constant_memory': True, 'strings_to_formulas': False, 'strings_to_urls': False})
     worksheet = workbook.add_worksheet()
-    with open(filename, 'rt') as f:
+    with open(filename, newline='') as f:
         reader = csv.reader(f)
         for r, row in enumerate(reader):
-            for c, col in enumerate(row):
-                worksheet.write(r, c, col.decode('utf-8'))
+            worksheet.write_row(r, 0, row)
     workbook.close()
 
 
@@ -1,16 +1,106 @@
 
-import json, random, re, time, os, urllib.parse
+import array, codecs, collections, email.utils, functools, hashlib, json, logging, random, re, threading, time, os, urllib.parse
 import concurrent
 from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timedelta
 from dataclasses import dataclass
 from typing import Callable
+import lxml.etree, lxml.html
 import requests
-from . import adt, pdict, services, settings, xpath
+from . import pdict, services, settings, xpath
 
 
+log = logging.getLogger(__name__)
+
 SUCCESS_STATUS = (200, )
 NON_RETRIABLE_STATUS = (404, )
+# seconds to back off before the first retry, doubling for each further retry
+RETRY_BACKOFF = 0.5
+# POST data longer than this is hashed in the cache key
+MAX_KEY_DATA = 1024
+# upper bound in seconds on how long a server can ask us to back off
+MAX_RETRY_AFTER = 300
+# size of the chunks response bodies are read in
+STREAM_CHUNK_SIZE = 65536
+# consecutive connection errors before a proxy is skipped
+MAX_PROXY_ERRORS = 3
+# number of precomputed throttle jitter multipliers
+JITTER_SIZE = 1024
+# how far into the body to look for a declared charset, as browsers do
+SNIFF_SIZE = 1024
+
+_CHARSET_RE = re.compile(r'charset=["\']?([\w\-:.]+)', re.IGNORECASE)
+_META_CHARSET_RE = re.compile(rb'''<meta[^>]+charset=["']?([\w\-:.]+)|<\?xml[^>]+encoding=["']([\w\-:.]+)''', re.IGNORECASE)
+# match the subtype as a whole, so binary types such as application/vnd.openxmlformats-... are not treated as text
+_TEXT_TYPE_RE = re.compile(r'^\s*(?:text/[\w.+-]+|[\w.+-]+/(?:[\w.-]+\+)?(?:json|xml)|[\w.+-]+/(?:x-)?javascript)\s*(?:;|$)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(pattern, flags=0):
+    """Compile regex once per pattern, independent of the re module's own cache
+    """
+    return re.compile(pattern, flags)
+
+
+def get_encoding(headers, content=b''):
+    """Return the charset declared in the Content-Type header, else for textual content the charset declared at the start of the body or utf-8, and None for binary
+
+    >>> get_encoding({'Content-Type': 'text/html; charset="ISO-8859-1"'})
+    'ISO-8859-1'
+    >>> get_encoding({'Content-Type': 'text/html'})
+    'utf-8'
+    >>> get_encoding({'Content-Type': 'application/ld+json'})
+    'utf-8'
+    >>> content = b'<html><head><meta charset="windows-1252"></head><body><p>caf\\xe9</p></body></html>'
+    >>> get_encoding({'Content-Type': 'text/html'}, content)
+    'windows-1252'
+    >>> str(Response(content, 200, 'OK', get_encoding({'Content-Type': 'text/html'}, content)).get('//p'))
+    'café'
+    >>> get_encoding({'Content-Type': 'image/png'})
+    >>> get_encoding({'Content-Type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'})
+    """
+    content_type = headers.get('Content-Type') or ''
+    match = _CHARSET_RE.search(content_type)
+    if match:
+        return match.group(1)
+    elif _TEXT_TYPE_RE.search(content_type):
+        match = _META_CHARSET_RE.search(content[:SNIFF_SIZE])
+        if match:
+            return (match.group(1) or match.group(2)).decode('ascii')
+        return 'utf-8'
+
+
+def get_retry_after(headers):
+    """Return how many seconds the server asks to wait before the next request, from the Retry-After or X-RateLimit headers
+
+    >>> get_retry_after({'Retry-After': '5'})
+    5.0
+    >>> get_retry_after({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '10'})
+    10.0
+    >>> get_retry_after({'X-RateLimit-Remaining': '50', 'X-RateLimit-Reset': '10'})
+    >>> get_retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+    0.0
+    """
+    seconds = None
+    retry_after = headers.get('Retry-After')
+    if retry_after:
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            # otherwise an HTTP date
+            try:
+                seconds = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    else:
+        try:
+            if int(headers.get('X-RateLimit-Remaining', 999)) < 2:
+                reset = float(headers.get('X-RateLimit-Reset'))
+                # the reset is either an epoch timestamp or a number of seconds
+                seconds = reset - time.time() if reset > 1e9 else reset
+        except (TypeError, ValueError):
+            pass
+    if seconds is not None:
+        return min(max(seconds, 0.0), MAX_RETRY_AFTER)
 
 
 @dataclass
@@ -20,37 +110,100 @@ class Request:
     data: str = None
     callback: Callable = None
 
-    def get_key(self):
-        """Create key for caching this request
+    @functools.cached_property
+    def encoded_data(self):
+        """The POST data, with a dict encoded once in sorted order so the same data gives the same key
+        """
+        if isinstance(self.data, dict):
+            return urllib.parse.urlencode(sorted(self.data.items()))
+        return self.data
+
+    @functools.cached_property
+    def key(self):
+        """Key for caching this request, built once
         """
         key = self.url
         if self.data:
-            key = '{} {}'.format(key, self.data)
+            data = self.encoded_data
+            if len(data) > MAX_KEY_DATA:
+                # bound the key size for large bodies
+                data = hashlib.blake2b(data.encode('utf-8') if isinstance(data, str) else data, digest_size=16).hexdigest()
+            key = '{} {}'.format(key, data)
         return key
 
+    def get_key(self):
+        """Create key for caching this request
+        """
+        return self.key
+
 
 class Response:
-    def __init__(self, text, status_code, reason):
-        self.text = text
+    def __init__(self, text, status_code, reason, encoding=None):
+        if encoding and isinstance(text, bytes):
+            # keep the raw body and only decode when text is first accessed
+            self._content = text
+            self._encoding = encoding
+        else:
+            self.text = text
         self.status_code = status_code
         self.reason = reason
-        self.tree = None
+
+    @functools.cached_property
+    def text(self):
+        # the raw body is kept so the response is still cached as bytes after being read
+        try:
+            return str(self._content, self._encoding, errors='replace')
+        except LookupError:
+            # unknown encoding
+            return str(self._content, errors='replace')
+
+    def __reduce__(self):
+        # pickle only the constructor arguments, which is more compact than the instance dict and leaves out the parsed tree and decoded text
+        if '_content' in self.__dict__:
+            return Response, (self._content, self.status_code, self.reason, self._encoding)
+        return Response, (self.text, self.status_code, self.reason)
+
+    def __setstate__(self, state):
+        """Restore responses pickled by older versions, which stored the instance dict including an unparsed tree
+
+        >>> import copyreg, io, pickle
+        >>> class OldPickler(pickle.Pickler):
+        ...     def reducer_override(self, obj):
+        ...         if isinstance(obj, Response):
+        ...             return copyreg.__newobj__, (Response,), {'text': obj.text, 'status_code': obj.status_code, 'reason': obj.reason, 'tree': None}
+        ...         return NotImplemented
+        >>> fp = io.BytesIO()
+        >>> OldPickler(fp, protocol=2).dump(Response('<p>hello</p>', 200, 'OK'))
+        >>> response = pickle.loads(fp.getvalue())
+        >>> str(response.get('//p'))
+        'hello'
+        """
+        # a stale tree would hide the cached property
+        state.pop('tree', None)
+        self.__dict__.update(state)
+
+    @functools.cached_property
+    def tree(self):
+        if '_content' in self.__dict__:
+            # parse the raw bytes with the known encoding rather than decoding to text first
+            try:
+                parser = xpath.html_parser(codecs.lookup(self._encoding).name)
+                return xpath.Tree(lxml.html.fromstring(self._content, parser=parser))
+            except (LookupError, lxml.etree.LxmlError):
+                pass
+        return xpath.Tree(self.text)
 
     def get(self, path):
-        if self.tree is None:
-            self.tree = xpath.Tree(self.text)
         return self.tree.get(path)
 
     def search(self, path):
-        if self.tree is None:
-            self.tree = xpath.Tree(self.text)
         return self.tree.search(path)
 
-    def regex(self, r):
-        return re.search(r, self.text)
+    def regex(self, r, flags=0):
+        return _compile(r, flags).search(self.text)
 
-    def findall(self, r):
-        return re.findall(r, self.text)
+    def findall(self, r, flags=0):
+        return _compile(r, flags).findall(self.text)
 
     def json(self):
         return json.loads(self.text)
@@ -66,46 +219,123 @@ class Throttle:
     def __init__(self, delay=0):
         self.delay = delay
         self.last_time = {}
+        self.paused = {}
+        self.lock = threading.Lock()
+        # cycle through precomputed jitter multipliers rather than drawing a random number each call
+        self.jitter = array.array('d', (0.5 + random.random() for _ in range(JITTER_SIZE)))
+        self.jitter_index = 0
 
-    def __call__(self, delay, ip):
+    def __call__(self, delay, ip, host=None):
         delay = self.delay if delay is None else delay
-        seconds = delay * (0.5 + random.random())
-        last_time = self.last_time.get(ip, datetime.now() - timedelta(seconds=seconds))
-        next_time = last_time + timedelta(seconds=seconds)
-        while next_time > datetime.now():
-            time.sleep(0.1)
-        self.last_time[ip] = next_time
+        with self.lock:
+            seconds = delay * self.jitter[self.jitter_index % JITTER_SIZE]
+            self.jitter_index += 1
+            # reserve the next slot for this ip before sleeping so concurrent threads queue behind it
+            now = time.monotonic()
+            next_time = max(now, self.last_time.get(ip, now - seconds) + seconds, self.paused.get(host, now))
+            self.last_time[ip] = next_time
+        if next_time > now:
+            time.sleep(next_time - now)
+
+    def pause(self, host, seconds):
+        """Hold back all requests to this host for the given number of seconds
+        """
+        with self.lock:
+            until = time.monotonic() + seconds
+            self.paused[host] = max(until, self.paused.get(host, until))
+
+    def remaining(self, host):
+        """Return how many seconds requests to this host are still paused for
+        """
+        with self.lock:
+            return max(self.paused.get(host, 0) - time.monotonic(), 0)
+
+
+class AdaptiveLimit:
+    def __init__(self, max_limit, min_limit=1, window=32):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        # start at the full limit and only back off once the host pushes back
+        self.limit = float(max_limit)
+        self.active = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a slot if one is free, returning whether it was, so the caller can schedule other work rather than block
+        """
+        with self.lock:
+            if self.active >= int(self.limit):
+                return False
+            self.active += 1
+            return True
+
+    def release(self, status_code=None, latency=None):
+        """Release a slot and adjust the limit: additive increase while responses are fast, halve on errors or rate limiting
+
+        Without a status code the request was not sent, so the limit is unchanged.
+        """
+        with self.lock:
+            self.active -= 1
+            if status_code is None:
+                pass
+            elif status_code == 429 or status_code >= 500:
+                self.limit = max(self.min_limit, self.limit * 0.5)
+            elif status_code in SUCCESS_STATUS:
+                # latency within twice the rolling mean counts as good
+                if not self.latencies or latency <= 2 * sum(self.latencies) / len(self.latencies):
+                    self.limit = min(self.max_limit, self.limit + 0.5)
+                self.latencies.append(latency)
 
 
 class Download:
-    def __init__(self, cache_file='', cache=None, session=None, delay=1, max_retries=1, proxy_file=None, proxies=None, cache_expires=None, timeout=30):
-        self.cache = cache or pdict.PersistentDict(cache_file or settings.cache_file, expires=cache_expires)
+    def __init__(self, cache_file='', cache=None, session=None, delay=1, max_retries=1, proxy_file=None, proxies=None, cache_expires=None, timeout=30, pool_maxsize=64, cache_memory_size=0, max_bytes=None):
+        # cached responses kept in memory are returned as the same object, so keep their parsed tree
+        self.cache = cache or pdict.PersistentDict(cache_file or settings.cache_file, expires=cache_expires, memory_size=cache_memory_size)
+        if session is None:
+            # share one session so connections are kept alive and reused across requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
         self.session = session
         self.timeout = timeout
+        # truncate response bodies larger than this
+        self.max_bytes = max_bytes
         self.max_retries = max_retries
-        self.proxies = open(proxy_file).read().splitlines() if proxy_file and os.path.exists(proxy_file) else proxies
+        # deque so proxies can be rotated in constant time
+        if proxy_file and os.path.exists(proxy_file):
+            with open(proxy_file) as fp:
+                self.proxies = collections.deque(line.rstrip('\r\n') for line in fp)
+        else:
+            self.proxies = collections.deque(proxies or [])
+        self._proxy_lock = threading.Lock()
+        self._default_headers = dict(settings.default_headers)
+        # consecutive connection errors for each proxy
+        self.proxy_errors = collections.Counter()
         self._throttle = Throttle(delay)
 
     def _format_headers(self, url, headers, user_agent):
-        headers = headers or {}
+        # merge into a copy so the defaults and caller's headers are not modified, with the caller's taking precedence
+        merged = self._default_headers.copy()
+        if headers:
+            merged.update(headers)
         if user_agent:
-            headers['User-Agent'] = user_agent
-        for name, value in settings.default_headers.items():
-            headers[name] = value
-        return headers
+            merged['User-Agent'] = user_agent
+        return merged
 
 
-    def _should_retry(self, response, num_failures=0):
+    def _should_retry(self, response, num_failures=0, max_retries=None):
         if response.status_code in SUCCESS_STATUS or response.status_code in NON_RETRIABLE_STATUS:
             return False
         else:
-            return num_failures < self.max_retries
+            return num_failures < (self.max_retries if max_retries is None else max_retries)
 
 
     def get(self, url, delay=None, max_retries=None, user_agent='', read_cache=True, write_cache=True, headers=None, data=None, ssl_verify=True, auto_encoding=True):
-        if isinstance(data, dict):
-            data = urllib.parse.urlencode(sorted(data.items()))
-        key = Request(url, data=data).get_key()
+        request = Request(url, data=data)
+        data = request.encoded_data
+        key = request.get_key()
         try:
             if not read_cache:
                 raise KeyError()
@@ -116,38 +346,76 @@ class Download:
                 raise KeyError()
 
         except KeyError:
-            if self.session is None:
-                session = requests.session()
-            else:
-                session = self.session
+            session = self.session
             headers = self._format_headers(url, headers, user_agent)
             max_retries = self.max_retries if max_retries is None else max_retries
+            host = urllib.parse.urlparse(url).hostname
             for num_failures in range(max_retries + 1):
+                if num_failures:
+                    # back off exponentially before retrying, unless the server already asked to wait longer
+                    self._throttle.pause(host, RETRY_BACKOFF * 2 ** (num_failures - 1))
                 proxies = self.get_proxy()
-                self._throttle(delay, proxies['http'] if proxies else None)
+                self._throttle(delay, proxies['http'] if proxies else None, host)
                 try:
                     if data is not None:
-                        request_response = session.post(url, headers=headers, data=data, verify=ssl_verify, proxies=proxies, timeout=self.timeout)
+                        request_response = session.post(url, headers=headers, data=data, verify=ssl_verify, proxies=proxies, timeout=self.timeout, stream=True)
                     else:
-                        request_response = session.get(url, headers=headers, verify=ssl_verify, proxies=proxies, timeout=self.timeout)
+                        request_response = session.get(url, headers=headers, verify=ssl_verify, proxies=proxies, timeout=self.timeout, stream=True)
+                    try:
+                        content = self._read_content(request_response)
+                    finally:
+                        request_response.close()
                 except Exception as e:
-                    print('Download error:', e)
+                    log.warning('Download error: %s', e)
                     response = Response('', 500, str(e))
+                    if proxies:
+                        with self._proxy_lock:
+                            self.proxy_errors[proxies['http']] += 1
                 else:
-                    print('Download:', url, request_response.status_code)
-                    content = request_response.content if not request_response.encoding or not auto_encoding else request_response.text
-                    response = Response(content, request_response.status_code, request_response.reason)
-                    if not self._should_retry(response, num_failures):
+                    if proxies:
+                        with self._proxy_lock:
+                            self.proxy_errors.pop(proxies['http'], None)
+                    log.info('Download: %s %s', url, request_response.status_code)
+                    encoding = get_encoding(request_response.headers, content) if auto_encoding else None
+                    response = Response(content, request_response.status_code, request_response.reason, encoding)
+                    # respect rate limits, which also holds back sibling threads downloading from this host
+                    retry_after = get_retry_after(request_response.headers)
+                    if retry_after:
+                        self._throttle.pause(host, retry_after)
+                    if not self._should_retry(response, num_failures, max_retries):
                         break
             if write_cache:
                 self.cache[key] = response
         return response
 
 
+    def _read_content(self, request_response):
+        """Read the response body in chunks, stopping at max_bytes
+        """
+        chunks = []
+        size = 0
+        for chunk in request_response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            if self.max_bytes is not None and size > self.max_bytes:
+                log.warning('Truncated response from %s at %d bytes', request_response.url, self.max_bytes)
+                return b''.join(chunks)[:self.max_bytes]
+        return b''.join(chunks)
+
+
     def get_proxy(self):
         if self.proxies:
-            proxy = self.proxies.pop()
-            self.proxies = [proxy] + self.proxies
+            # lock so threads reading and rotating concurrently do not get the same proxy
+            with self._proxy_lock:
+                # skip proxies that keep failing, unless they all are
+                for _ in range(len(self.proxies)):
+                    proxy = self.proxies[-1]
+                    self.proxies.rotate(1)
+                    if self.proxy_errors[proxy] < MAX_PROXY_ERRORS:
+                        break
+                else:
+                    proxy = self.proxies[-1]
+                    self.proxies.rotate(1)
             return {
                 'http': proxy,
                 'https': proxy,
@@ -159,58 +427,149 @@ class Download:
         return gm.geocode(address)
 
 
-    def threaded(self, requests, max_workers=4, max_queue=1000, filter_duplicates=True):
+    def _write_cache(self, items):
+        """Write these (key, response) pairs to the cache, in a single batch when supported
+        """
+        if hasattr(self.cache, 'setitems'):
+            self.cache.setitems(items)
+        else:
+            for key, response in items:
+                self.cache[key] = response
+
+
+    def threaded(self, requests, max_workers=4, max_queue=1000, filter_duplicates=True, cache_batch_size=100, cache_batch_bytes=16*1024*1024, parse_html=False):
         def process_callback(request, response):
             if request.callback:
                 for next_request in request.callback(request, response) or []:
                     if isinstance(next_request, Request):
-                        if filter_duplicates:
-                            if next_request.get_key() in seen:
-                                continue
-                            else:
-                                seen.add(next_request.get_key())
+                        if filter_duplicates and not is_new(next_request):
+                            continue
                         requests.append(next_request)
                     else:
                         yield next_request
 
-        seen = adt.HashDict()
+        def timed_get(host, **kwargs):
+            if self._throttle.remaining(host):
+                # the host was paused after this request was submitted, so hand it back rather than sleep in this worker
+                return None, 0
+            start = time.monotonic()
+            # retries are scheduled by the caller, so their backoff does not hold a worker either
+            response = self.get(max_retries=0, **kwargs)
+            if parse_html and response:
+                # lxml releases the GIL while parsing, so build the tree in parallel here rather than in the callback
+                response.tree
+            return response, time.monotonic() - start
+
+        # adapt the number of concurrent downloads per host, holding requests back here rather than blocking worker threads
+        limits = collections.defaultdict(lambda: AdaptiveLimit(max_workers))
+        waiting = collections.defaultdict(collections.deque)
+        num_waiting = 0
+        # hosts with waiting requests that are paused for Retry-After or a retry backoff
+        paused = set()
+        # failed attempts for each request being retried
+        failures = collections.Counter()
+        def submit(host):
+            nonlocal num_waiting
+            if waiting[host] and self._throttle.remaining(host):
+                paused.add(host)
+                return
+            while waiting[host] and limits[host].acquire():
+                request = waiting[host].popleft()
+                num_waiting -= 1
+                future = executor.submit(timed_get, host, url=request.url, headers=request.headers, data=request.encoded_data, read_cache=False, write_cache=False)
+                future_to_request[future] = request
+
+        def hold(host, request):
+            # put the request back at the front of its host's queue
+            nonlocal num_waiting
+            waiting[host].appendleft(request)
+            num_waiting += 1
+            submit(host)
+
+        # store a fixed size digest of each key to bound memory on large crawls
+        seen = set()
+        def is_new(request):
+            digest = hashlib.blake2b(request.key.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+            if digest in seen:
+                return False
+            seen.add(digest)
+            return True
+
         if filter_duplicates:
-            filtered_requests = []
-            for request in requests:
-                if request.get_key() not in seen:
-                    seen.add(request.get_key())
-                    filtered_requests.append(request)
-            requests = filtered_requests
+            requests = [request for request in requests if is_new(request)]
+        # crawl breadth first
+        requests = collections.deque(requests)
+        future_to_request = {}
+        pending = []
+        pending_bytes = 0
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            while requests:
-                # avoid loading too many requests into memory at once
-                cur_requests = []
-                for _ in range(max_queue):
-                    if requests:
-                        cur_requests.append(requests.pop())
-                    else:
-                        break
-
-                future_to_request = {}
-                for request in cur_requests:
-                    try:
-                        response = self.cache[request.get_key()]
-                        if self._should_retry(response):
-                            raise KeyError()
-                    except KeyError:
-                        future = executor.submit(self.get, url=request.url, headers=request.headers, data=request.data, read_cache=False, write_cache=False)
-                        future_to_request[future] = request
-                    else:
-                        yield from process_callback(request, response)
+            try:
+                while requests or future_to_request or num_waiting:
+                    # top up the downloads in progress, avoiding loading too many requests into memory at once
+                    while requests and len(future_to_request) + num_waiting < max_queue:
+                        cur_requests = [requests.popleft() for _ in range(min(len(requests), max_queue - len(future_to_request) - num_waiting))]
+
+                        # read the cached requests in a single query when supported
+                        if hasattr(self.cache, 'getitems'):
+                            cached = self.cache.getitems([request.key for request in cur_requests])
+                        else:
+                            cached = self.cache
+
+                        for request in cur_requests:
+                            try:
+                                response = cached[request.key]
+                                if self._should_retry(response):
+                                    raise KeyError()
+                            except KeyError:
+                                host = urllib.parse.urlparse(request.url).hostname
+                                waiting[host].append(request)
+                                num_waiting += 1
+                                submit(host)
+                            else:
+                                yield from process_callback(request, response)
 
-                # process the completed callbacks
-                for future in concurrent.futures.as_completed(future_to_request):
-                    request = future_to_request[future]
-                    try:
-                        response = future.result()
-                    except Exception as e:
-                        print('{} generated an exception: {}'.format(request.url, e))
+                    # wake up for the first paused host to resume, if before any download completes
+                    timeout = min((self._throttle.remaining(host) for host in paused), default=None)
+                    if future_to_request:
+                        done, _ = concurrent.futures.wait(future_to_request, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
                     else:
-                        self.cache[request.get_key()] = response
+                        time.sleep(timeout or 0)
+                        done = ()
+                    for host in [host for host in paused if not self._throttle.remaining(host)]:
+                        paused.discard(host)
+                        submit(host)
+
+                    # process callbacks as soon as any download completes, buffering the cache writes
+                    for future in done:
+                        request = future_to_request.pop(future)
+                        host = urllib.parse.urlparse(request.url).hostname
+                        try:
+                            response, latency = future.result()
+                        except Exception as e:
+                            log.error('%s generated an exception: %s', request.url, e)
+                            limits[host].release(500, 0)
+                            submit(host)
+                            continue
+                        if response is None:
+                            limits[host].release()
+                            hold(host, request)
+                            continue
+                        limits[host].release(response.status_code, latency)
+                        if self._should_retry(response, failures[request.key]):
+                            failures[request.key] += 1
+                            # back off exponentially, unless the server already asked to wait longer
+                            self._throttle.pause(host, RETRY_BACKOFF * 2 ** (failures[request.key] - 1))
+                            hold(host, request)
+                            continue
+                        failures.pop(request.key, None)
+                        submit(host)
+                        pending.append((request.key, response))
+                        pending_bytes += len(getattr(response, '_content', None) or response.text or '')
+                        # flush by count or size of the bodies, and whenever the downloads in progress run out
+                        if len(pending) >= cache_batch_size or pending_bytes >= cache_batch_bytes or not future_to_request:
+                            self._write_cache(pending)
+                            pending = []
+                            pending_bytes = 0
                         yield from process_callback(request, response)
-                    del future_to_request[future]
+            finally:
+                self._write_cache(pending)
@@ -4,6 +4,7 @@ It uses pickle to store Python objects and strings, which are then compressed
 Multithreading is supported
 """
 
+import collections
 import os
 import sys
 import datetime
@@ -16,11 +17,50 @@ import hashlib
 import shutil
 import glob
 import pickle
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 DEFAULT_LIMIT = 1000
 DEFAULT_TIMEOUT = 10000
+# maximum number of keys to check in a single query, within sqlite's limit on variables
+MAX_VARIABLES = 500
+# first bytes of a zstd frame, used to detect how a value was compressed
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# prefixes recording the type of each stored value
+BYTES_TAG, STR_TAG, PICKLE_TAG = b'B', b'S', b'P'
 
 
+def key_hash(key):
+    """Return a signed 64 bit hash of this key, to use as the rowid
+
+    >>> key_hash('http://example.com') == key_hash('http://example.com')
+    True
+    >>> -2**63 <= key_hash('http://example.com') < 2**63
+    True
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8', 'surrogatepass')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big', signed=True)
+
+
+class CompressedWriter:
+    """File like object that compresses data as it is written
+    """
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(self.compressor.compress(data))
+
+    def getvalue(self):
+        """Return all the compressed data
+        """
+        self.chunks.append(self.compressor.flush())
+        return b''.join(self.chunks)
+
 
 class PersistentDict:
     """Stores and retrieves persistent data through a dict-like interface
@@ -36,6 +76,13 @@ class PersistentDict:
         how long should a thread wait for sqlite to be ready (in ms)
     isolation_level: 
         None for autocommit or else 'DEFERRED' / 'IMMEDIATE' / 'EXCLUSIVE'
+        The database uses write-ahead logging, so while open it also has -wal and -shm files alongside that should be removed with it.
+    compression:
+        'zlib' or 'zstd', which compresses HTML several times faster but requires the zstandard package.
+        Values are decompressed based on their format, so a cache can be switched between them.
+    memory_size:
+        how many recently used values to also keep in memory, so hot keys skip sqlite and decompression. Disabled by default.
+        Values in memory are shared rather than copied, so should not be modified, and writes by other processes are not seen.
 
     >>> cache = PersistentDict()
     >>> url = 'http://google.com/abc'
@@ -62,41 +109,75 @@ class PersistentDict:
     >>> del cache[url]
     >>> url in cache
     False
+    >>> cache.conn.close()
     >>> os.remove(cache.filename)
     """
-    def __init__(self, filename='cache.db', compress_level=6, expires=None, timeout=DEFAULT_TIMEOUT, isolation_level=None):
+    def __init__(self, filename='cache.db', compress_level=6, expires=None, timeout=DEFAULT_TIMEOUT, isolation_level=None, compression='zlib', memory_size=0):
         """initialize a new PersistentDict with the specified database file.
         """
         self.filename = filename
-        self.compress_level, self.expires, self.timeout, self.isolation_level = \
-            compress_level, expires, timeout, isolation_level
+        self.compress_level, self.expires, self.timeout, self.isolation_level, self.compression, self.memory_size = \
+            compress_level, expires, timeout, isolation_level, compression, memory_size
+        # least recently used (value, updated) pairs
+        self._memory = collections.OrderedDict()
+        self._memory_lock = threading.Lock()
+        if compression == 'zstd':
+            if zstandard is None:
+                raise ImportError('zstd compression requires the zstandard package')
+            self._zstd_compressor = zstandard.ZstdCompressor(level=compress_level)
+        elif compression != 'zlib':
+            raise ValueError('Unknown compression: %s' % compression)
+        # meta for new keys is always empty so only serialize once
+        self._empty_meta = self.serialize({})
         self.conn = sqlite3.connect(filename, timeout=timeout, isolation_level=isolation_level, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
         #self.conn.text_factory = lambda x: str(x)
+        self.conn.create_function('key_hash', 1, key_hash, deterministic=True)
+        # rows are looked up by a 64 bit hash of the key, which is the rowid so needs no separate index of the full keys
         sql = """
         CREATE TABLE IF NOT EXISTS config (
-            key TEXT NOT NULL PRIMARY KEY UNIQUE,
+            key_hash INTEGER PRIMARY KEY,
+            key TEXT NOT NULL,
             value BLOB,
             meta BLOB,
             status INTEGER,
             updated timestamp DEFAULT (datetime('now', 'localtime'))
         );
         """
-        self.conn.execute(sql)
-        self.conn.execute("CREATE INDEX IF NOT EXISTS keys ON config (key);")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(config);")]
+        if columns and 'key_hash' not in columns:
+            # migrate table from earlier versions that were keyed by the full key
+            with self.conn:
+                if not self.conn.in_transaction:
+                    self.conn.execute("BEGIN;")
+                self.conn.execute("ALTER TABLE config RENAME TO config_old;")
+                self.conn.execute(sql)
+                self.conn.execute("INSERT OR REPLACE INTO config (key_hash, key, value, meta, status, updated) SELECT key_hash(key), key, value, meta, status, updated FROM config_old;")
+                self.conn.execute("DROP TABLE config_old;")
+        else:
+            self.conn.execute(sql)
+        # write ahead log so writes only need to sync at checkpoints and readers do not block writers
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute("PRAGMA temp_store=MEMORY;")
 
 
     def __copy__(self):
         """make a copy of current cache settings
         """
         return PersistentDict(filename=self.filename, compress_level=self.compress_level, expires=self.expires, 
-                              timeout=self.timeout, isolation_level=self.isolation_level)
+                              timeout=self.timeout, isolation_level=self.isolation_level, compression=self.compression,
+                              memory_size=self.memory_size)
 
 
     def __contains__(self, key):
         """check the database to see if a key exists
         """
-        row = self.conn.execute("SELECT updated FROM config WHERE key=?;", (key,)).fetchone()
-        return row and self.is_fresh(row[0])
+        cutoff = self.cutoff()
+        if cutoff is None:
+            row = self.conn.execute("SELECT 1 FROM config WHERE key_hash=? AND key=?;", (key_hash(key), key)).fetchone()
+        else:
+            row = self.conn.execute("SELECT 1 FROM config WHERE key_hash=? AND key=? AND updated>?;", (key_hash(key), key, cutoff)).fetchone()
+        return row is not None
 
 
     def contains(self, keys, ignore_expires=False):
@@ -108,16 +189,57 @@ class PersistentDict:
         >>> cache.contains(['a', 'b'])
         []
         >>> cache.contains(['a', 'b'], ignore_expires=True)
-        [u'a']
+        ['a']
+        >>> cache.conn.close()
         >>> os.remove(cache.filename)
         """
-        results = []
-        c = self.conn.cursor()
-        c.execute("SELECT key, updated FROM config WHERE key IN (%s);" % ','.join(len(keys)*'?'), keys)
-        for row in c:
-            if ignore_expires or self.is_fresh(row[1]):
-                results.append(row[0])
-        return results
+        found = self.contains_many(keys, ignore_expires)
+        return [key for key in keys if key in found]
+
+
+    def contains_many(self, keys, ignore_expires=False):
+        """return the set of these keys that exist, with freshness checked by sqlite
+        """
+        return {row[0] for row in self._select_many('key', keys, ignore_expires)}
+
+
+    def getitems(self, keys, ignore_expires=False):
+        """return a dict of the values for these keys that exist, fetched in a single query per batch rather than one per key
+
+        >>> cache = PersistentDict()
+        >>> cache.setitems([('a', 1), ('b', 2)])
+        >>> sorted(cache.getitems(['a', 'b', 'c']).items())
+        [('a', 1), ('b', 2)]
+        >>> cache.conn.close()
+        >>> os.remove(cache.filename)
+        """
+        return {key: self.deserialize(value) for key, value in self._select_many('key, value', keys, ignore_expires)}
+
+
+    def _select_many(self, columns, keys, ignore_expires):
+        """yield these columns, starting with the key, for the keys that exist, in batches within sqlite's limit on variables
+        """
+        keys = list(keys)
+        cutoff = None if ignore_expires else self.cutoff()
+        for i in range(0, len(keys), MAX_VARIABLES):
+            batch = keys[i:i + MAX_VARIABLES]
+            params = [key_hash(key) for key in batch]
+            sql = "SELECT %s FROM config WHERE key_hash IN (%s)" % (columns, ','.join(len(batch)*'?'))
+            if cutoff is not None:
+                sql += " AND updated>?"
+                params.append(cutoff)
+            # skip any hash collisions with other keys
+            batch = set(batch)
+            for row in self.conn.execute(sql + ';', params):
+                if row[0] in batch:
+                    yield row
+
+
+    def cutoff(self):
+        """returns the datetime that data must be updated after to be fresh, or None if data does not expire
+        """
+        if self.expires is not None:
+            return datetime.datetime.now() - self.expires
         
 
     def __iter__(self):
@@ -146,12 +268,31 @@ class PersistentDict:
 
     def __getitem__(self, key):
         """return the value of the specified key or raise KeyError if not found
+
+        >>> cache = PersistentDict(memory_size=1)
+        >>> cache['a'] = 1; cache['b'] = 2
+        >>> list(cache._memory)
+        ['b']
+        >>> cache['a']
+        1
+        >>> list(cache._memory)
+        ['a']
+        >>> cache.conn.close()
+        >>> os.remove(cache.filename)
         """
-        row = self.conn.execute("SELECT value, updated FROM config WHERE key=?;", (key,)).fetchone()
+        if self.memory_size:
+            with self._memory_lock:
+                row = self._memory.get(key)
+                if row is not None:
+                    self._memory.move_to_end(key)
+            if row is not None and self.is_fresh(row[1]):
+                return row[0]
+        row = self.conn.execute("SELECT value, updated FROM config WHERE key_hash=? AND key=?;", (key_hash(key), key)).fetchone()
         if row:
             if self.is_fresh(row[1]):
-                value = row[0]
-                return self.deserialize(value)
+                value = self.deserialize(row[0])
+                self._remember(key, value, row[1])
+                return value
             else:
                 raise KeyError("Key `%s' is stale" % key)
         else:
@@ -161,28 +302,117 @@ class PersistentDict:
     def __delitem__(self, key):
         """remove the specifed value from the database
         """
-        self.conn.execute("DELETE FROM config WHERE key=?;", (key,))
+        self.conn.execute("DELETE FROM config WHERE key_hash=? AND key=?;", (key_hash(key), key))
+        self._forget(key)
 
 
     def __setitem__(self, key, value):
         """set the value of the specified key
         """
         updated = datetime.datetime.now()
-        self.conn.execute("INSERT OR REPLACE INTO config (key, value, meta, updated) VALUES(?, ?, ?, ?);", (
-            key, self.serialize(value), self.serialize({}), updated)
+        self.conn.execute("INSERT OR REPLACE INTO config (key_hash, key, value, meta, updated) VALUES(?, ?, ?, ?, ?);", (
+            key_hash(key), key, self.serialize(value), self._empty_meta, updated)
         )
+        self._remember(key, value, updated)
+
+
+    def _remember(self, key, value, updated):
+        """keep this value in memory, evicting the least recently used when full
+        """
+        if self.memory_size:
+            with self._memory_lock:
+                self._memory[key] = value, updated
+                self._memory.move_to_end(key)
+                if len(self._memory) > self.memory_size:
+                    self._memory.popitem(last=False)
+
+
+    def _forget(self, key=None):
+        """remove this key from memory, or all keys when None
+        """
+        if self.memory_size:
+            with self._memory_lock:
+                if key is None:
+                    self._memory.clear()
+                else:
+                    self._memory.pop(key, None)
+
+
+    def setitems(self, items):
+        """set multiple (key, value) pairs in a single transaction, which is much faster than setting each
+
+        >>> cache = PersistentDict()
+        >>> cache.setitems([('a', 1), ('b', 2)])
+        >>> cache['a'], cache['b']
+        (1, 2)
+        >>> cache.conn.close()
+        >>> os.remove(cache.filename)
+        """
+        items = list(items)
+        updated = datetime.datetime.now()
+        rows = [(key_hash(key), key, self.serialize(value), self._empty_meta, updated) for key, value in items]
+        if rows:
+            with self.conn:
+                if not self.conn.in_transaction:
+                    self.conn.execute("BEGIN;")
+                self.conn.executemany("INSERT OR REPLACE INTO config (key_hash, key, value, meta, updated) VALUES(?, ?, ?, ?, ?);", rows)
+            for key, value in items:
+                self._remember(key, value, updated)
 
 
     def serialize(self, value):
-        """convert object to a compressed pickled string to save in the db
+        """convert object to a compressed string to save in the db, prefixed with a tag for its type
+        Strings and bytes are stored directly while other objects are pickled
         """
-        return sqlite3.Binary(zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), self.compress_level))
+        if isinstance(value, bytes):
+            tag, data = BYTES_TAG, value
+        elif isinstance(value, str):
+            tag, data = STR_TAG, value.encode('utf-8', 'surrogatepass')
+        else:
+            tag, data = PICKLE_TAG, None
+        if self.compression == 'zstd':
+            compressor = self._zstd_compressor.compressobj()
+        else:
+            compressor = zlib.compressobj(self.compress_level)
+        writer = CompressedWriter(compressor)
+        if data is None:
+            # compress the pickle as it is written rather than building the full pickle first
+            pickle.Pickler(writer, protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+        else:
+            writer.write(data)
+        return sqlite3.Binary(tag + writer.getvalue())
     
     def deserialize(self, value):
-        """convert compressed pickled string from database back into an object
+        """convert compressed string from database back into an object
+
+        >>> cache = PersistentDict()
+        >>> [cache.deserialize(cache.serialize(value)) for value in (b'abc', 'abc', ['abc'])]
+        [b'abc', 'abc', ['abc']]
+        >>> cache.deserialize(zlib.compress(pickle.dumps('abc')))
+        'abc'
+        >>> cache.conn.close()
+        >>> os.remove(cache.filename)
         """
         if value:
-            return pickle.loads(zlib.decompress(value), encoding='latin1')
+            tag = value[:1]
+            if tag in (BYTES_TAG, STR_TAG, PICKLE_TAG):
+                value = memoryview(value)[1:]
+            else:
+                # stored before values were tagged
+                tag = PICKLE_TAG
+            if value[:4] == ZSTD_MAGIC:
+                if zstandard is None:
+                    raise ImportError('zstd compressed value requires the zstandard package')
+                # streamed frames do not record their size, so decompress with a stream too
+                data = zstandard.ZstdDecompressor().decompressobj().decompress(value)
+            else:
+                data = zlib.decompress(value)
+
+            if tag == BYTES_TAG:
+                return data
+            elif tag == STR_TAG:
+                return data.decode('utf-8', 'surrogatepass')
+            return pickle.loads(data, encoding='latin1')
 
 
     def is_fresh(self, t):
@@ -196,7 +426,7 @@ class PersistentDict:
         """
         data = default
         if key:
-            row = self.conn.execute("SELECT value, meta, updated FROM config WHERE key=?;", (key,)).fetchone()
+            row = self.conn.execute("SELECT value, meta, updated FROM config WHERE key_hash=? AND key=?;", (key_hash(key), key)).fetchone()
             if row:
                 if ignore_expires or self.is_fresh(row[2]):
                     value = row[0] 
@@ -216,20 +446,22 @@ class PersistentDict:
         """
         if value is None:
             # want to get meta
-            row = self.conn.execute("SELECT meta FROM config WHERE key=?;", (key,)).fetchone()
+            row = self.conn.execute("SELECT meta FROM config WHERE key_hash=? AND key=?;", (key_hash(key), key)).fetchone()
             if row:
                 return self.deserialize(row[0])
             else:
                 raise KeyError("Key `%s' does not exist" % key)
         else:
             # want to set meta
-            self.conn.execute("UPDATE config SET meta=?, updated=? WHERE key=?;", (self.serialize(value), datetime.datetime.now(), key))
+            self.conn.execute("UPDATE config SET meta=?, updated=? WHERE key_hash=? AND key=?;", (self.serialize(value), datetime.datetime.now(), key_hash(key), key))
+            self._forget(key)
 
 
     def clear(self):
         """Clear all cached data
         """
         self.conn.execute("DELETE FROM config;")
+        self._forget()
 
 
     def merge(self, db, override=False):
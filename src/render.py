@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 
-import os, re, signal, sys, time, urllib, zipfile
+import logging, os, re, signal, sys, time, urllib, zipfile
 from http.cookiejar import Cookie, CookieJar
-from . import download, xpath
+from . import download, pdict, settings
+from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver import Chrome
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By 
 from selenium.webdriver.common.proxy import Proxy, ProxyType
 
+log = logging.getLogger(__name__)
+
+_PROXY_AUTH_RE = re.compile(r'//(.*?):(.*?)@(.*?):(\d+)')
+_PROXY_PLAIN_RE = re.compile(r'([\d\.]+):(\d+)')
+
 
 class CacheBrowser:
     def __init__(self, executable_path='~/bin/chromedriver', headless=True, cache=None, cookie_jar=None, cookie_key=None, proxy=None, init_callback=None):
@@ -24,12 +30,13 @@ class CacheBrowser:
 
         self.browser = None
         #self.capabilities = webdriver.DesiredCapabilities.CHROME
-        self.cache = download.Download().cache if cache is None else cache
+        # keep recently used pages and cookies in memory too
+        self.cache = pdict.PersistentDict(settings.cache_file, memory_size=256) if cache is None else cache
         self.cookie_key = cookie_key
         if cookie_key:
             try:
                 self.cookies = self.cache[cookie_key]
-                print('loading:', self.cookies)
+                log.debug('loading: %s', self.cookies)
             except KeyError:
                 self.cookies = []
         else:
@@ -69,7 +76,7 @@ class CacheBrowser:
                 cookies.append(cookie)
         if loaded_cookies:
             # need to reload page with cookies
-            print('reload cookies')
+            log.debug('reload cookies')
             self.browser.get(url)
             self.cookies = cookies
 
@@ -81,15 +88,15 @@ class CacheBrowser:
 
     def save_cookies(self):
         if self.cookie_key is not None and self.browser is not None:
-            print('saving:', self.browser.get_cookies())
+            log.debug('saving: %s', self.browser.get_cookies())
             self.cache[self.cookie_key] = self.browser.get_cookies()
 
     def parse_proxy(self, http_proxy):
-        match = re.search('//(.*?):(.*?)@(.*?):(\d+)', http_proxy)
+        match = _PROXY_AUTH_RE.search(http_proxy)
         if match:
             proxy_user, proxy_pass, proxy_host, proxy_port = match.groups()
         else:
-            match = re.match('([\d\.]+):(\d+)', http_proxy)
+            match = _PROXY_PLAIN_RE.match(http_proxy)
             proxy_host, proxy_port = match.groups()
             proxy_user = proxy_pass = ''
         return proxy_user, proxy_pass, proxy_host, proxy_port
@@ -172,16 +179,23 @@ class CacheBrowser:
                 raise KeyError()
         except KeyError:
             self.init()
-            print('Downloading:', url)
+            log.info('Downloading: %s', url)
             self.browser.get(url)
             time.sleep(delay)
             if wait_xpath:
                 self.wait(wait_xpath)
             self.load_cookies(url)
-            html = self.browser.page_source
-            # chrome will wrap JSON in pre - how to solve this properly?
-            if '<body><pre>{' in html:
-                html = xpath.get(html, '/html/body/pre')
+            # chrome will wrap JSON in pre, so read the JSON from the DOM rather than parsing the page source
+            content_type = self.browser.execute_script('return document.contentType') or ''
+            html = None
+            if 'json' in content_type:
+                try:
+                    html = self.browser.find_element(By.TAG_NAME, 'pre').text
+                except NoSuchElementException:
+                    # not wrapped
+                    pass
+            if html is None:
+                html = self.browser.page_source
             response = download.Response(html, 200, '')
             if write_cache:
                 self.cache[url] = response
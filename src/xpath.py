@@ -1,36 +1,94 @@
-import itertools, re, sys, urllib, urllib.parse
+import concurrent.futures, functools, itertools, logging, re, sys, threading, urllib, urllib.parse
 from optparse import OptionParser
 import lxml.html
 import lxml.etree
 
+log = logging.getLogger(__name__)
+
+_XML_DECL_RE = re.compile(r'\ufeff?\s*<\?xml\b', re.IGNORECASE)
+# a single descendant step by tag with an optional attribute test, which ElementPath matches in the same order as XPath
+_DESCENDANT_PATH_RE = re.compile(r"""^(\.?)//([A-Za-z_][\w.-]*)(\[@[A-Za-z_][\w.-]*(?:=(?:'[^']*'|"[^"]*"))?\])?$""")
+# paths selecting text or attributes, which lxml already returns as strings
+_STRING_PATH_RE = re.compile(r'/(?:text\(\)|@[\w.:*-]+)$')
+_SELECTED_XPATH = lxml.etree.XPath('.//option[@selected]/@value')
+_parsers = threading.local()
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(path, namespaces=None):
+    """Compile XPath once per path and namespace items rather than parsing the expression on each search
+    """
+    return lxml.etree.XPath(path, namespaces=dict(namespaces) if namespaces else None)
+
+
+def _namespace_key(namespaces):
+    """Return namespaces as hashable items for the XPath cache
+    """
+    return tuple(sorted(namespaces.items())) if namespaces else None
+
+
+def html_parser(encoding=None):
+    """Return a reusable HTML parser for this thread, which skips the ID hash table and libxml2's document size limits
+    """
+    cache = _parsers.__dict__.setdefault('cache', {})
+    parser = cache.get(encoding)
+    if parser is None:
+        parser = cache[encoding] = lxml.html.HTMLParser(encoding=encoding, collect_ids=False, huge_tree=True)
+    return parser
+
 
 class Tree:
+    # a Tree is created for every search result, so avoid a __dict__ per instance
+    __slots__ = ('doc', 'value')
+
     def __init__(self, doc, **kwargs):
+        self.value = None
         if doc is None:
             self.doc = None
-        elif isinstance(doc, lxml.html.HtmlElement):
-            # input is already a passed lxml tree
+        elif isinstance(doc, lxml.etree._ElementUnicodeResult):
+            # attribute or text result from a search, which is kept as is rather than parsed as HTML
+            self.doc = None
+            self.value = str(doc)
+        elif isinstance(doc, lxml.etree._Element):
+            # input is already a parsed lxml tree, including comments
             self.doc = doc
+        elif isinstance(doc, (str, bytes)) and not doc.strip():
+            # empty bodies are common when crawling, so skip lxml which would only raise for them
+            self.doc = None
         else:
+            if isinstance(doc, str) and _XML_DECL_RE.match(doc):
+                # lxml does not accept unicode strings with an encoding declaration, so encode up front rather than failing first
+                doc = doc.encode('utf-8')
             try:
                 try:
-                    self.doc = lxml.html.fromstring(doc)
+                    self.doc = lxml.html.fromstring(doc, parser=html_parser())
                 except ValueError:
                     # For error: Unicode strings with encoding declaration are not supported. Please use bytes input or XML fragments without declaration
-                    self.doc = lxml.html.fromstring(doc.encode('utf-8'))
+                    self.doc = lxml.html.fromstring(doc.encode('utf-8'), parser=html_parser())
             except lxml.etree.LxmlError as e:
-                if doc.strip():
-                    print('Error parsing doc:', e)
+                log.warning('Error parsing doc: %s', e)
                 self.doc = None
 
-    def search(self, path):
+    def search(self, path, namespaces=None, **variables):
+        """Return the results of this XPath as Trees
+
+        Values that vary between searches can be passed as XPath variables, such as search('//div[@id=$id]', id=x),
+        so the path is only compiled once. Namespaces is an optional dict of prefixes to URIs.
+        """
         if self.doc is None:
             return []
         else:
-            return [Tree(e) for e in self.doc.xpath(path)]
+            m = _DESCENDANT_PATH_RE.match(path)
+            if m:
+                relative, tag, test = m.groups()
+                root = self.doc if relative else self.doc.getroottree().getroot()
+                if relative or root.tag != tag:
+                    # ElementPath skips the XPath engine, though unlike XPath it never matches the root itself
+                    return [Tree(e) for e in root.iterfind('.//' + tag + (test or ''))]
+            return [Tree(e) for e in _compile(path, _namespace_key(namespaces))(self.doc, **variables)]
 
-    def get(self, path):
-        es = self.search(path)
+    def get(self, path, namespaces=None, **variables):
+        es = self.search(path, namespaces, **variables)
         if es:
             return es[0]
         else:
@@ -38,28 +96,62 @@ class Tree:
 
     def __str__(self):
         if self.doc is None:
-            return ''
+            return self.value or ''
         else:
             try:
-                parts = [self.doc.text] + [c if isinstance(c, str) else lxml.etree.tostring(c).decode() for c in self.doc] + [self.doc.tail]
-                return ''.join(filter(None, parts)) #or str(self.doc)
+                if len(self.doc) == 0:
+                    # leaf nodes, the common case, have no children to serialize
+                    return (self.doc.text or '') + (self.doc.tail or '')
+                return ''.join(self._parts())
             except AttributeError as e:
-                print('Error parsing node:', e)
+                log.warning('Error parsing node: %s', e)
                 return ''
 
+    def _parts(self):
+        """Yield the text, serialized children with their tails, and tail of this node
+        """
+        if self.doc.text:
+            yield self.doc.text
+        for c in self.doc.iterchildren():
+            yield lxml.etree.tostring(c, encoding='unicode', with_tail=True)
+        if self.doc.tail:
+            yield self.doc.tail
+
+    def text(self):
+        """Return just the text of this node and its descendants, extracted by lxml in a single pass
+        """
+        if self.doc is None:
+            return self.value or ''
+        return lxml.etree.tostring(self.doc, method='text', encoding='unicode', with_tail=False)
+
     def __bool__(self):
-        return self.doc is not None
+        return self.doc is not None or bool(self.value)
 
 
-def get(html, xpath, remove=None):
-    """Return first element from XPath search of HTML
+def parse(html, **kwargs):
+    """Return a Tree of this HTML, or the Tree itself when already parsed, so repeated queries only parse once
     """
-    return str(Tree(html, remove=remove).get(xpath))
+    return html if isinstance(html, Tree) else Tree(html, **kwargs)
 
-def search(html, xpath, remove=None):
-    """Return all elements from XPath search of HTML
+def parse_many(docs, workers=None):
+    """Return a list of Trees for these documents, parsed in a thread pool since lxml releases the GIL while parsing
     """
-    return [str(e) for e in Tree(html, remove=remove).search(xpath)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(parse, docs))
+
+def get(html, xpath, remove=None, namespaces=None, **variables):
+    """Return first element from XPath search of HTML or a parsed Tree
+    """
+    return str(parse(html, remove=remove).get(xpath, namespaces, **variables))
+
+def search(html, xpath, remove=None, namespaces=None, **variables):
+    """Return all elements from XPath search of HTML or a parsed Tree
+    """
+    tree = parse(html, remove=remove)
+    if tree.doc is not None and _STRING_PATH_RE.search(xpath):
+        # use the strings lxml returned rather than wrapping each in a Tree, though a union may also return elements
+        return [str(e) if isinstance(e, str) else str(Tree(e)) for e in _compile(xpath, _namespace_key(namespaces))(tree.doc, **variables)]
+    return [str(e) for e in tree.search(xpath, namespaces, **variables)]
 
 
 class Form:
@@ -67,14 +159,23 @@ class Form:
     """
     def __init__(self, form):
         self.data = {}
-        for input_name, input_value in zip(search(form, '//input/@name'), search(form, '//input/@value')):
-            self.data[input_name] = input_value
-        for text_name, text_value in zip(search(form, '//textarea/@name'), search(form, '//textarea')):
-            self.data[text_name] = text_value
-        for select_name, select_contents in zip(search(form, '//select/@name'), search(form, '//select')):
-            self.data[select_name] = get(select_contents, '/option[@selected]/@value')
-        if '' in self.data:
-            del self.data['']
+        self._encoded = None
+        # parse once and read each field from its own element, so fields without a value stay aligned
+        doc = parse(form).doc
+        if doc is not None:
+            # find all the fields in a single traversal by lxml's tag iterator, without the XPath engine
+            for e in doc.iter('input', 'textarea', 'select'):
+                if not e.get('name'):
+                    continue
+                if e.tag == 'textarea':
+                    # textarea content is raw text, and a Tree would also include the tail after the element
+                    value = e.text or ''
+                elif e.tag == 'select':
+                    values = _SELECTED_XPATH(e)
+                    value = values[0] if values else ''
+                else:
+                    value = e.get('value', '')
+                self.data[e.get('name')] = value
 
     def __getitem__(self, key):
         return self.data[key]
@@ -82,8 +183,22 @@ class Form:
     def __setitem__(self, key, value):
         self.data[key] = value
 
+    def _snapshot(self):
+        """Return a copy of the data with list values as tuples, so later changes to those lists are also detected
+        """
+        return {key: tuple(value) if isinstance(value, list) else value for key, value in self.data.items()}
+
     def __str__(self):
-        return urllib.urlencode(self.data)
+        # reuse the encoding while the data is unchanged, which is cheaper to check than requoting every field
+        snapshot = self._snapshot()
+        if self._encoded is None or self._encoded[0] != snapshot:
+            self._encoded = snapshot, urllib.parse.urlencode(self.data, doseq=True)
+        return self._encoded[1]
+
+    def to_bytes(self):
+        """Return the encoded form data as bytes, ready to send as a request body
+        """
+        return str(self).encode('ascii')
 
     def submit(self, D, action, **argv):
         return D.get(url=action, data=self.data, **argv)